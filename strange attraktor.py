@@ -3,8 +3,42 @@ import pygame
 from pygame.locals import *
 from OpenGL.GL import *
 from OpenGL.GLU import *
+from OpenGL.GL import shaders
 from dataclasses import dataclass
+from numba import njit
 import colorsys
+import ctypes
+import math
+
+MAX_TRAJ = 256
+VERTEX_BYTES = 4 * 4  # Interleaved float32 x, y, z, speed
+SUBSTEPS = 10  # Integrator steps per rendered frame
+
+# fastmath without the nnan/ninf flags, so the finiteness checks below survive
+FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+# Trails carry a per-vertex speed that the fragment shader maps to a hue
+TRAIL_VERTEX_SHADER = """
+#version 120
+attribute float speed;
+varying float v_speed;
+
+void main() {
+    gl_Position = gl_ModelViewProjectionMatrix * gl_Vertex;
+    v_speed = speed;
+}
+"""
+
+TRAIL_FRAGMENT_SHADER = """
+#version 120
+uniform sampler1D hue_lut;
+varying float v_speed;
+
+void main() {
+    // A negative speed marks the white starting point of a trajectory
+    gl_FragColor = v_speed < 0.0 ? vec4(1.0) : texture1D(hue_lut, fract(v_speed / 10.0));
+}
+"""
 
 @dataclass
 class AttractorParams:
@@ -15,15 +49,113 @@ class AttractorParams:
     max_radius: float = 100.0
     color_scale: float = 0.5
 
+@njit(fastmath=FASTMATH, cache=True)
+def lorenz_step(x, y, z, a, b, c, dt):
+    """Advance a single point by one classical RK4 Lorenz step with stability checks"""
+    # Stages are written out in full rather than calling a derivative function
+    k1x = a * (y - x)
+    k1y = x * (b - z) - y
+    k1z = x * y - c * z
+    
+    hx = x + 0.5 * dt * k1x
+    hy = y + 0.5 * dt * k1y
+    hz = z + 0.5 * dt * k1z
+    k2x = a * (hy - hx)
+    k2y = hx * (b - hz) - hy
+    k2z = hx * hy - c * hz
+    
+    hx = x + 0.5 * dt * k2x
+    hy = y + 0.5 * dt * k2y
+    hz = z + 0.5 * dt * k2z
+    k3x = a * (hy - hx)
+    k3y = hx * (b - hz) - hy
+    k3z = hx * hy - c * hz
+    
+    hx = x + dt * k3x
+    hy = y + dt * k3y
+    hz = z + dt * k3z
+    k4x = a * (hy - hx)
+    k4y = hx * (b - hz) - hy
+    k4z = hx * hy - c * hz
+    
+    dx = (k1x + 2.0 * k2x + 2.0 * k3x + k4x) / 6.0
+    dy = (k1y + 2.0 * k2y + 2.0 * k3y + k4y) / 6.0
+    dz = (k1z + 2.0 * k2z + 2.0 * k3z + k4z) / 6.0
+    
+    # Check for numerical stability
+    if not (math.isfinite(dx) and math.isfinite(dy) and math.isfinite(dz)):
+        return x, y, z
+    
+    # Limit maximum step size
+    max_step = 100.0
+    scale = min(1.0, max_step / (math.sqrt(dx*dx + dy*dy + dz*dz) + 1e-10))
+    return x + dt * dx * scale, y + dt * dy * scale, z + dt * dz * scale
+
+@njit(fastmath=FASTMATH, cache=True)
+def checked_step(x, y, z, a, b, c, dt, max_radius):
+    """Take one lorenz_step and return the new point, the step length and whether it is valid"""
+    nx, ny, nz = lorenz_step(x, y, z, a, b, c, dt)
+    vx = nx - x
+    vy = ny - y
+    vz = nz - z
+    speed = math.sqrt(vx*vx + vy*vy + vz*vz)
+    
+    # Both ends must lie within max_radius and the step must not be longer than it.
+    # NaN and infinity fail these comparisons as well.
+    max_r_sq = max_radius * max_radius
+    valid = x*x + y*y + z*z <= max_r_sq and nx*nx + ny*ny + nz*nz <= max_r_sq and speed <= max_radius
+    return nx, ny, nz, speed, valid
+
+@njit(fastmath=FASTMATH, cache=True)
+def step_lorenz(state, ring, head, a, b, c, dt, max_radius):
+    """Advance each row of an (N, 3) state array by SUBSTEPS Lorenz steps in place.
+    
+    Trajectory i writes its (x, y, z, speed) vertices to ring[head:head + SUBSTEPS, i],
+    wrapping around the ring. A trajectory stops at its first invalid step and
+    repeats its last vertex for the rest of the frame.
+    """
+    n_slots = ring.shape[0]
+    for i in range(state.shape[0]):
+        x = float(state[i, 0])
+        y = float(state[i, 1])
+        z = float(state[i, 2])
+        speed = float(ring[(head - 1) % n_slots, i, 3])
+        stopped = False
+        for k in range(SUBSTEPS):
+            if not stopped:
+                nx, ny, nz, step_speed, valid = checked_step(x, y, z, a, b, c, dt, max_radius)
+                if valid:
+                    x, y, z, speed = nx, ny, nz, step_speed
+                else:
+                    stopped = True
+            slot = (head + k) % n_slots
+            ring[slot, i, 0] = x
+            ring[slot, i, 1] = y
+            ring[slot, i, 2] = z
+            ring[slot, i, 3] = speed
+        state[i, 0] = x
+        state[i, 1] = y
+        state[i, 2] = z
+
+
 class ChaoticAttractorVis:
     def __init__(self, width=1400, height=900):
         pygame.init()
+        
+        # Only queue the event types handle_input reacts to
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed([QUIT, MOUSEBUTTONDOWN, MOUSEBUTTONUP, MOUSEMOTION, KEYDOWN])
+        
         self.width = width
         self.height = height
         pygame.display.set_mode((width, height), DOUBLEBUF | OPENGL)
         pygame.display.set_caption('3D Chaos Visualization')
         self.color_offset = 0.0
         
+        # Text overlay: the font is loaded once and the last rendered line is reused
+        self.font = pygame.font.Font(None, 36)
+        self.text_cache = None  # (text, width, height) of the line in text_texture
+        
         # Camera parameters
         self.camera_distance = 50.0
         self.min_zoom = 5.0
@@ -40,25 +172,38 @@ class ChaoticAttractorVis:
         self.camera_up = np.array([0.0, 1.0, 0.0])
         self.follow_distance = 30.0  # Distance from camera to followed point
         
-        # Click-to-place parameters
+        # Click-to-place parameters, cached by draw() whenever the free-mode view changes
         self.unproject_matrix = None
         self.projection_matrix = None
         self.modelview_matrix = None
+        self.viewport = (0, 0, width, height)
+        self.cached_view = None
         
         # Attractor parameters
         self.params = AttractorParams()
-        self.trajectories = []
         self.max_points = 5000
+        self.n_traj = 0
+        self.state = np.empty((MAX_TRAJ, 3), dtype=np.float32)  # Current position of each trajectory
+        
+        # Trail ring buffer, indexed [slot, trajectory]. All trajectories advance by
+        # SUBSTEPS slots per frame, so one frame's vertices are a contiguous block.
+        self.vertices = np.empty((self.max_points, MAX_TRAJ, 4), dtype=np.float32)
+        self.points = self.vertices[..., :3]
+        self.head = 0  # Next slot to write, shared by all trajectories
+        self.length = np.zeros(MAX_TRAJ, dtype=np.int64)  # Number of stored points
+        
+        # Velocity color map: hue over [0, 1) at full saturation, value 0.8, sampled on the GPU
+        self.hue_lut = np.array([colorsys.hsv_to_rgb(i / 1024, 1.0, 0.8) for i in range(1024)], dtype=np.float32)
         
         # View offset for model centering
         self.offset_x = 0.0
         self.offset_y = 0.0
         
-        # Initial trajectory
-        self.add_trajectory(np.array([0.1, 0.1, 0.1]))
-        
         # Setup OpenGL
         self.setup_gl()
+        
+        # Initial trajectory
+        self.add_trajectory(np.array([0.1, 0.1, 0.1], dtype=np.float32))
 
     def setup_gl(self):
         """Initialize OpenGL settings"""
@@ -67,29 +212,94 @@ class ChaoticAttractorVis:
         glEnable(GL_BLEND)
         glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
         glLineWidth(1.5)
+        
+        # One VBO holds the ring buffer, laid out like self.vertices
+        self.vbo = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferData(GL_ARRAY_BUFFER, self.vertices.nbytes, None, GL_DYNAMIC_DRAW)
+        
+        # Static indices that walk trajectory i's slots in order. Row i holds
+        # max_points + 1 entries; the last one repeats slot 0, so a wrapped trail
+        # is drawn as the two strips [start, max_points] and [0, head).
+        slots = np.arange(self.max_points + 1) % self.max_points
+        self.trail_indices = (slots[np.newaxis, :] * MAX_TRAJ + np.arange(MAX_TRAJ)[:, np.newaxis]).astype(np.uint32)
+        self.ibo = glGenBuffers(1)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ibo)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.trail_indices.nbytes, self.trail_indices, GL_STATIC_DRAW)
+        
+        self.trail_program = shaders.compileProgram(
+            shaders.compileShader(TRAIL_VERTEX_SHADER, GL_VERTEX_SHADER),
+            shaders.compileShader(TRAIL_FRAGMENT_SHADER, GL_FRAGMENT_SHADER)
+        )
+        speed_attrib = glGetAttribLocation(self.trail_program, "speed")
+        
+        self.vao = glGenVertexArrays(1)
+        glBindVertexArray(self.vao)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glVertexPointer(3, GL_FLOAT, VERTEX_BYTES, ctypes.c_void_p(0))
+        glEnableVertexAttribArray(speed_attrib)
+        glVertexAttribPointer(speed_attrib, 1, GL_FLOAT, GL_FALSE, VERTEX_BYTES, ctypes.c_void_p(12))
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ibo)
+        glBindVertexArray(0)
+        
+        # Hue color map as a repeating 1D texture on unit 0
+        self.hue_texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_1D, self.hue_texture)
+        glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_WRAP_S, GL_REPEAT)
+        glTexImage1D(GL_TEXTURE_1D, 0, GL_RGB8, len(self.hue_lut), 0, GL_RGB, GL_FLOAT, self.hue_lut)
+        glBindTexture(GL_TEXTURE_1D, 0)
+        
+        glUseProgram(self.trail_program)
+        glUniform1i(glGetUniformLocation(self.trail_program, "hue_lut"), 0)
+        glUseProgram(0)
+        
+        # Text overlay: the rendered line lives in a texture drawn on a unit quad,
+        # interleaved as x, y, u, v and scaled to the text size at draw time
+        self.text_texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.text_texture)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        
+        quad = np.array([[0, 0, 0, 0], [1, 0, 1, 0], [0, 1, 0, 1], [1, 1, 1, 1]], dtype=np.float32)
+        self.quad_vbo = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.quad_vbo)
+        glBufferData(GL_ARRAY_BUFFER, quad.nbytes, quad, GL_STATIC_DRAW)
+        
+        self.quad_vao = glGenVertexArrays(1)
+        glBindVertexArray(self.quad_vao)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glVertexPointer(2, GL_FLOAT, quad.strides[0], ctypes.c_void_p(0))
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        glTexCoordPointer(2, GL_FLOAT, quad.strides[0], ctypes.c_void_p(8))
+        glBindVertexArray(0)
 
     def update_camera_follow(self):
         """Update camera position when in follow mode"""
-        if not self.trajectories or not self.follow_mode:
+        if not self.n_traj or not self.follow_mode:
             return
 
         # Get the latest point and its velocity
-        current_traj = self.trajectories[-1]
-        if len(current_traj['points']) < 2:
+        current_traj = self.n_traj - 1
+        if self.length[current_traj] < 2:
             return
 
-        current_pos = np.array(current_traj['points'][-1])
-        prev_pos = np.array(current_traj['points'][-2])
+        current_pos = self.latest_point(current_traj).copy()
+        prev_pos = self.latest_point(current_traj, age=1)
         
         # Calculate velocity direction
         velocity = current_pos - prev_pos
-        velocity_norm = np.linalg.norm(velocity)
+        velocity_sq = float(velocity @ velocity)
         
-        if velocity_norm < 1e-6:
+        if velocity_sq < 1e-12:
             return
             
         # Normalize velocity
-        velocity = velocity / velocity_norm
+        velocity = velocity * (1.0 / math.sqrt(velocity_sq))
         
         # Calculate desired camera position
         desired_camera_pos = current_pos - velocity * self.follow_distance
@@ -99,11 +309,11 @@ class ChaoticAttractorVis:
         
         # Calculate up vector (try to keep it mostly vertical)
         right = np.cross(velocity, [0, 1, 0])
-        right_norm = np.linalg.norm(right)
-        if right_norm > 1e-6:
-            right = right / right_norm
-            self.camera_up = np.cross(right, velocity)
-            self.camera_up = self.camera_up / np.linalg.norm(self.camera_up)
+        right_sq = float(right @ right)
+        if right_sq > 1e-12:
+            right = right * (1.0 / math.sqrt(right_sq))
+            up = np.cross(right, velocity)
+            self.camera_up = up * (1.0 / math.sqrt(float(up @ up)))
 
         # Update target position
         self.target_position = current_pos
@@ -127,16 +337,34 @@ class ChaoticAttractorVis:
             glTranslatef(self.offset_x, self.offset_y, -self.camera_distance)
             glRotatef(self.rot_x, 1, 0, 0)
             glRotatef(self.rot_y, 0, 1, 0)
+            
+            # Read the matrices back only when the view changed, not on every click
+            view = (self.rot_x, self.rot_y, self.offset_x, self.offset_y, self.camera_distance)
+            if view != self.cached_view:
+                self.projection_matrix = np.array(glGetDoublev(GL_PROJECTION_MATRIX))
+                self.modelview_matrix = np.array(glGetDoublev(GL_MODELVIEW_MATRIX))
+                # GL matrices are column-major, so transpose before combining
+                self.unproject_matrix = np.linalg.inv(self.projection_matrix.T @ self.modelview_matrix.T)
+                self.cached_view = view
         
         # Draw all attractor trails
-        for traj in self.trajectories:
-            if len(traj['points']) > 1:
-                glBegin(GL_LINE_STRIP)
-                for point, color in zip(traj['points'], traj['colors']):
-                    if self.is_point_valid(point):
-                        glColor3fv(color)
-                        glVertex3fv(point)
-                glEnd()
+        n = self.n_traj
+        if n:
+            lengths = self.length[:n]
+            starts = (self.head - lengths) % self.max_points
+            bases = np.arange(n) * self.trail_indices.shape[1]
+            wrapped = starts + lengths > self.max_points
+            firsts = np.concatenate((bases + starts, bases[wrapped]))
+            counts = np.concatenate((np.where(wrapped, self.max_points + 1 - starts, lengths),
+                                     np.full(np.count_nonzero(wrapped), self.head))).astype(np.int32)
+            offsets = (ctypes.c_void_p * len(firsts))(*(firsts * self.trail_indices.itemsize).tolist())
+            glUseProgram(self.trail_program)
+            glBindTexture(GL_TEXTURE_1D, self.hue_texture)
+            glBindVertexArray(self.vao)
+            glMultiDrawElements(GL_LINE_STRIP, counts, GL_UNSIGNED_INT, offsets, len(firsts))
+            glBindVertexArray(0)
+            glBindTexture(GL_TEXTURE_1D, 0)
+            glUseProgram(0)
         
         # Draw parameters and camera mode
         mode_text = "Follow Mode" if self.follow_mode else "Free Mode"
@@ -144,7 +372,13 @@ class ChaoticAttractorVis:
 
     def handle_input(self):
         """Handle user input for camera control"""
-        for event in pygame.event.get():
+        events = pygame.event.get()
+        for i, event in enumerate(events):
+            # Motion is read from the current cursor position, so only the last
+            # event in a run of MOUSEMOTION events needs handling
+            if event.type == MOUSEMOTION and i + 1 < len(events) and events[i + 1].type == MOUSEMOTION:
+                continue
+            
             if event.type == QUIT:
                 return False
             
@@ -196,8 +430,8 @@ class ChaoticAttractorVis:
                     self.follow_mode = not self.follow_mode
                     if self.follow_mode:
                         # Initialize follow camera position
-                        if self.trajectories and len(self.trajectories[-1]['points']) > 0:
-                            self.current_camera_pos = np.array(self.trajectories[-1]['points'][-1])
+                        if self.n_traj and self.length[self.n_traj - 1] > 0:
+                            self.current_camera_pos = self.latest_point(self.n_traj - 1).astype(np.float64)
                             self.current_camera_pos[2] += self.follow_distance
                 elif event.key == K_r:  # Reset view
                     self.rot_x = 0.0
@@ -207,8 +441,8 @@ class ChaoticAttractorVis:
                     self.camera_distance = 50.0
                     self.follow_distance = 30.0
                 elif event.key == K_c:  # Clear trajectories
-                    self.trajectories.clear()
-                    self.add_trajectory(np.array([0.1, 0.1, 0.1]))
+                    self.n_traj = 0
+                    self.add_trajectory(np.array([0.1, 0.1, 0.1], dtype=np.float32))
                 elif event.key == K_a:
                     self.params.a += 1.0
                 elif event.key == K_s:
@@ -222,45 +456,24 @@ class ChaoticAttractorVis:
 
     def update_position(self):
         """Update the positions of all trajectories with stability checks"""
-        for traj in self.trajectories:
-            try:
-                current_pos = traj['current_pos']
-                if not self.is_point_valid(current_pos):
-                    continue
-                
-                x, y, z = current_pos
-                dx, dy, dz = self.calculate_attractor(x, y, z, self.params)
-                
-                new_pos = current_pos + np.array([dx, dy, dz]) * self.params.dt
-                
-                # Skip update if new position is invalid
-                if not self.is_point_valid(new_pos):
-                    continue
-                
-                velocity = new_pos - current_pos
-                speed = np.linalg.norm(velocity)
-                
-                # Skip if velocity is too high
-                if not np.isfinite(speed) or speed > self.params.max_radius:
-                    continue
-                
-                # Generate color based on velocity
-                hue = (speed % 10) / 10
-                color = [c for c in colorsys.hsv_to_rgb(hue, 1.0, 0.8)]
-                
-                traj['points'].append(new_pos)
-                traj['colors'].append(color)
-                
-                # Limit the number of points
-                if len(traj['points']) > self.max_points:
-                    traj['points'].pop(0)
-                    traj['colors'].pop(0)
-                
-                traj['current_pos'] = new_pos
-                
-            except Exception as e:
-                print(f"Error updating position: {e}")
-                continue
+        n = self.n_traj
+        if n:
+            # Append this frame's steps; their speeds are turned into colors by the trail shader
+            step_lorenz(self.state[:n], self.vertices, self.head, self.params.a, self.params.b, self.params.c,
+                        self.params.dt, self.params.max_radius)
+            
+            # The new slots are contiguous across trajectories, so upload them in one
+            # call, or two when they wrap past the end of the ring
+            end = self.head + SUBSTEPS
+            glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+            if end > self.max_points:
+                self.upload_vertices(self.head, self.max_points, n)
+                self.upload_vertices(0, end - self.max_points, n)
+            else:
+                self.upload_vertices(self.head, end, n)
+            
+            self.head = end % self.max_points
+            self.length[:n] = np.minimum(self.length[:n] + SUBSTEPS, self.max_points)
 
         # Update camera if in follow mode
         if self.follow_mode:
@@ -269,45 +482,22 @@ class ChaoticAttractorVis:
     # Include the rest of the unchanged methods from the original code
     def is_point_valid(self, point):
         """Check if a point is within valid bounds and numerically stable"""
-        if not np.all(np.isfinite(point)):  # Check for NaN and infinity
-            return False
-        if np.linalg.norm(point) > self.params.max_radius:
-            return False
-        return True
-    
-    def calculate_attractor(self, x, y, z, params):
-        """Calculate next point for the Lorenz attractor with stability checks"""
-        try:
-            dx = params.a * (y - x)
-            dy = x * (params.b - z) - y
-            dz = x * y - params.c * z
-            
-            # Check for numerical stability
-            if not all(np.isfinite(v) for v in (dx, dy, dz)):
-                return 0.0, 0.0, 0.0
-                
-            # Limit maximum step size
-            max_step = 100.0
-            scale = min(1.0, max_step / (np.sqrt(dx*dx + dy*dy + dz*dz) + 1e-10))
-            return dx * scale, dy * scale, dz * scale
-            
-        except Exception as e:
-            print(f"Error in attractor calculation: {e}")
-            return 0.0, 0.0, 0.0
+        x, y, z = point.tolist()
+        dist_sq = x*x + y*y + z*z  # NaN or infinity in any coordinate carries through
+        return math.isfinite(dist_sq) and dist_sq <= self.params.max_radius ** 2
     
     def add_trajectory(self, start_pos):
         """Add a new trajectory with given starting position and random direction"""
         try:
             # Ensure start_pos is valid
             if not self.is_point_valid(start_pos):
-                start_pos = np.array([0.1, 0.1, 0.1])
+                start_pos = np.array([0.1, 0.1, 0.1], dtype=np.float32)
             
             # Add small random variations to the starting position
-            random_direction = np.random.randn(3)
-            norm = np.linalg.norm(random_direction)
-            if norm > 1e-10:  # Prevent division by zero
-                random_direction = random_direction / norm
-                variation = random_direction * 0.1
+            random_direction = np.random.randn(3).astype(np.float32)
+            norm_sq = float(random_direction @ random_direction)
+            if norm_sq > 1e-20:  # Prevent division by zero
+                variation = random_direction * (0.1 / math.sqrt(norm_sq))
                 new_pos = start_pos + variation
                 
                 # Verify new position is valid
@@ -316,54 +506,100 @@ class ChaoticAttractorVis:
             else:
                 new_pos = start_pos
             
-            self.trajectories.append({
-                'points': [new_pos],
-                'colors': [(1.0, 1.0, 1.0)],  # Start with white
-                'current_pos': new_pos.copy()
-            })
+            if self.n_traj >= MAX_TRAJ:
+                print(f"Trajectory limit ({MAX_TRAJ}) reached")
+                return
+            
+            # The starting point goes in the newest slot, so the next frame continues from it
+            i = self.n_traj
+            slot = (self.head - 1) % self.max_points
+            self.state[i] = new_pos
+            self.vertices[slot, i, :3] = new_pos
+            self.vertices[slot, i, 3] = -1.0  # Start with white
+            self.length[i] = 1
+            glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+            glBufferSubData(GL_ARRAY_BUFFER, (slot * MAX_TRAJ + i) * VERTEX_BYTES, VERTEX_BYTES,
+                            self.vertices[slot, i])
+            self.n_traj += 1
         except Exception as e:
             print(f"Error adding trajectory: {e}")
     
+    def upload_vertices(self, first, last, n):
+        """Upload slots [first, last) of the first n trajectories to the bound VBO"""
+        # Rows are MAX_TRAJ vertices wide, so the block ends n vertices into the last row
+        data = self.vertices.reshape(-1, 4)[first * MAX_TRAJ:(last - 1) * MAX_TRAJ + n]
+        glBufferSubData(GL_ARRAY_BUFFER, first * MAX_TRAJ * VERTEX_BYTES, data.nbytes, data)
+    
+    def latest_point(self, i, age=0):
+        """Return the newest point of trajectory i, or an older one by age"""
+        return self.points[(self.head - 1 - age) % self.max_points, i]
+    
     def unproject_mouse(self, mouse_x, mouse_y):
         """Convert mouse coordinates to 3D world coordinates with safety checks"""
         try:
-            viewport = glGetIntegerv(GL_VIEWPORT)
-            modelview = glGetDoublev(GL_MODELVIEW_MATRIX)
-            projection = glGetDoublev(GL_PROJECTION_MATRIX)
+            if self.unproject_matrix is None:  # Nothing drawn yet
+                return np.array([0.1, 0.1, 0.1], dtype=np.float32)
             
-            win_y = viewport[3] - mouse_y
+            # Mouse position on the near and far clip planes in normalized device coordinates
+            vp_x, vp_y, vp_width, vp_height = self.viewport
+            ndc_x = 2.0 * (mouse_x - vp_x) / vp_width - 1.0
+            ndc_y = 1.0 - 2.0 * (mouse_y - vp_y) / vp_height
+            ndc = np.array([[ndc_x, ndc_y, -1.0, 1.0],
+                            [ndc_x, ndc_y, 1.0, 1.0]])
             
-            near_point = gluUnProject(mouse_x, win_y, 0.0, modelview, projection, viewport)
-            far_point = gluUnProject(mouse_x, win_y, 1.0, modelview, projection, viewport)
+            world = ndc @ self.unproject_matrix.T
+            near_point, far_point = world[:, :3] / world[:, 3:]
             
             if not (np.all(np.isfinite(near_point)) and np.all(np.isfinite(far_point))):
-                return np.array([0.1, 0.1, 0.1])
+                return np.array([0.1, 0.1, 0.1], dtype=np.float32)
             
-            direction = np.array(far_point) - np.array(near_point)
-            norm = np.linalg.norm(direction)
+            direction = far_point - near_point
+            norm_sq = float(direction @ direction)
             
-            if norm < 1e-10:  # Prevent division by zero
-                return np.array([0.1, 0.1, 0.1])
+            if norm_sq < 1e-20:  # Prevent division by zero
+                return np.array([0.1, 0.1, 0.1], dtype=np.float32)
                 
-            direction = direction / norm
-            point = np.array(near_point) + direction * 20
+            point = near_point + direction * (20 / math.sqrt(norm_sq))
             
             # Ensure point is within valid bounds
             if not self.is_point_valid(point):
-                return np.array([0.1, 0.1, 0.1])
+                return np.array([0.1, 0.1, 0.1], dtype=np.float32)
                 
-            return point
+            return point.astype(np.float32)
             
         except Exception as e:
             print(f"Error in unproject_mouse: {e}")
-            return np.array([0.1, 0.1, 0.1])
+            return np.array([0.1, 0.1, 0.1], dtype=np.float32)
 
     def draw_text(self, text):
-        """Draw text overlay"""
-        pygame.display.get_surface().fill((0, 0, 0, 0))
-        font = pygame.font.Font(None, 36)
-        text_surface = font.render(text, True, (255, 255, 255))
-        pygame.display.get_surface().blit(text_surface, (10, 10))
+        """Draw text overlay, re-uploading the glyphs only when the text changes"""
+        if self.text_cache is None or self.text_cache[0] != text:
+            text_surface = self.font.render(text, True, (255, 255, 255))
+            width, height = text_surface.get_size()
+            glBindTexture(GL_TEXTURE_2D, self.text_texture)
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE,
+                         pygame.image.tobytes(text_surface, "RGBA", True))  # Flipped to GL's bottom-up rows
+            glBindTexture(GL_TEXTURE_2D, 0)
+            self.text_cache = (text, width, height)
+        
+        # Draw the texture in window coordinates, 10px from the top-left corner
+        _, width, height = self.text_cache
+        glPushMatrix()
+        glLoadIdentity()
+        glOrtho(0, self.width, 0, self.height, -1, 1)
+        glTranslatef(10, self.height - 10 - height, 0)
+        glScalef(width, height, 1)
+        
+        glDisable(GL_DEPTH_TEST)
+        glEnable(GL_TEXTURE_2D)
+        glBindTexture(GL_TEXTURE_2D, self.text_texture)
+        glBindVertexArray(self.quad_vao)
+        glDrawArrays(GL_TRIANGLE_STRIP, 0, 4)
+        glBindVertexArray(0)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        glDisable(GL_TEXTURE_2D)
+        glEnable(GL_DEPTH_TEST)
+        glPopMatrix()
     
     def run(self):
         """Main loop"""